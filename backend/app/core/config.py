@@ -36,6 +36,9 @@ class Settings(BaseSettings):
         60 * 24 * 1
     )  # 60 minutes * 24 hours * 1 day = 1 day
     SCHEDULER_INACTIVE_USERS: int = 60 * 1  # 60 seconds * 1 minute = 1 minute
+    EXPIRED_TOKENS_RETENTION_SECONDS: int = (
+        60 * 60 * 24 * 7
+    )  # 60 seconds * 60 minutes * 24 hours * 7 days = 7 days
     MONGO_HOST: str
     MONGO_PORT: int
     MONGO_USER: str
@@ -43,8 +46,9 @@ class Settings(BaseSettings):
     MONGO_DB: str
     MONGODB_URL: Optional[DatabaseURL]
     DATABASE_NAME: Optional[str]
-    MAX_CONNECTIONS_COUNT: str
-    MIN_CONNECTIONS_COUNT: str
+    MAX_CONNECTIONS_COUNT: int
+    MIN_CONNECTIONS_COUNT: int
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: int = 2000  # Fail fast when the pool is exhausted
     MAIL_USERNAME: str
     MAIL_PASSWORD: str
     MAIL_FROM: str
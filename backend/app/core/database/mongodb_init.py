@@ -1,9 +1,12 @@
 import logging
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
 
 from app.core.config import settings
 from app.core.database.mongodb import database
+from app.repositories.token import create_token_indexes
+from app.repositories.user import create_user_indexes
 
 
 async def connect_to_mongo():
@@ -12,10 +15,24 @@ async def connect_to_mongo():
         str(settings.MONGODB_URL),
         maxPoolSize=settings.MAX_CONNECTIONS_COUNT,
         minPoolSize=settings.MIN_CONNECTIONS_COUNT,
+        waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
     )
+    # Open the first connection now instead of on the first request
+    await database.client.admin.command("ping")
     logging.info("MongoDB: Connection Successful!")
 
 
+async def create_mongo_indexes():
+    logging.info("MongoDB: Create indexes...")
+    for create_indexes in (create_token_indexes, create_user_indexes):
+        try:
+            await create_indexes(database.client)
+        except OperationFailure:
+            # e.g. existing duplicate emails / usernames, clean them up and restart
+            logging.exception(f"MongoDB: {create_indexes.__name__} failed")
+    logging.info("MongoDB: Indexes created!")
+
+
 async def close_mongo_connection():
     logging.info("MongoDB: Close Connection...")
     database.client.close()
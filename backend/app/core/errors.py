@@ -1,10 +1,10 @@
 from typing import Any, List, Optional
 
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
 from pydantic import EnumError, EnumMemberError, StrRegexError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.requests import Request
-from starlette.responses import UJSONResponse
 
 
 def parse_error(err: Any, field_names: List, raw: bool = True) -> Optional[dict]:
@@ -121,7 +121,7 @@ def raw_errors_to_fields(raw_errors: List) -> List[dict]:
 
 async def http_exception_handler(
     request: Request, exc: StarletteHTTPException
-) -> UJSONResponse:
+) -> ORJSONResponse:
     """
     Handles StarletteHTTPException, translating it into flat dict error data:
         * code - unique code of the error in the system
@@ -130,7 +130,7 @@ async def http_exception_handler(
 
     :param request: Starlette Request instance
     :param exc: StarletteHTTPException instance
-    :return: UJSONResponse with newly formatted error data
+    :return: ORJSONResponse with newly formatted error data
     """
     fields = getattr(exc, "fields", [])
     message = getattr(exc, "detail", "Validation error")
@@ -144,12 +144,12 @@ async def http_exception_handler(
         "message": message,
         "fields": fields,
     }
-    return UJSONResponse(data, status_code=exc.status_code, headers=headers)
+    return ORJSONResponse(data, status_code=exc.status_code, headers=headers)
 
 
 async def validation_exception_handler(
     request: Request, exc: RequestValidationError
-) -> UJSONResponse:
+) -> ORJSONResponse:
     """
     Handles ValidationError, translating it into flat dict error data:
         * code - unique code of the error in the system
@@ -158,7 +158,7 @@ async def validation_exception_handler(
 
     :param request: Starlette Request instance
     :param exc: StarletteHTTPException instance
-    :return: UJSONResponse with newly formatted error data
+    :return: ORJSONResponse with newly formatted error data
     """
     status_code = getattr(exc, "status_code", 400)
     headers = getattr(exc, "headers", None)
@@ -176,28 +176,28 @@ async def validation_exception_handler(
         message = message + "."  # pragma: no cover
 
     data = {"error_codes": error_codes, "message": message, "fields": fields}
-    return UJSONResponse(data, status_code=status_code, headers=headers)
+    return ORJSONResponse(data, status_code=status_code, headers=headers)
 
 
 async def not_found_error_handler(
     request: Request, exc: RequestValidationError
-) -> UJSONResponse:
+) -> ORJSONResponse:
     code = getattr(exc, "error_code", 404)
     detail = getattr(exc, "detail", "Not found")
     fields = getattr(exc, "fields", [])
     headers = getattr(exc, "headers", None)
     status_code = getattr(exc, "status_code", 404)
     data = {"error_codes": [code], "message": detail, "fields": fields}
-    return UJSONResponse(data, status_code=status_code, headers=headers)
+    return ORJSONResponse(data, status_code=status_code, headers=headers)
 
 
 async def internal_server_error_handler(
     request: Request, exc: RequestValidationError
-) -> UJSONResponse:
+) -> ORJSONResponse:
     code = getattr(exc, "error_code", 500)
     detail = getattr(exc, "detail", "Internal Server Error")
     fields = getattr(exc, "fields", [])
     headers = getattr(exc, "headers", None)
     status_code = getattr(exc, "status_code", 500)
     data = {"error_codes": [code], "message": detail, "fields": fields}
-    return UJSONResponse(data, status_code=status_code, headers=headers)
+    return ORJSONResponse(data, status_code=status_code, headers=headers)
@@ -0,0 +1,124 @@
+import hashlib
+import hmac
+import time
+from asyncio import get_running_loop
+from binascii import Error as BinasciiError
+from typing import Any, Optional, Type
+
+import orjson
+from jwt import (
+    DecodeError,
+    ExpiredSignatureError,
+    ImmatureSignatureError,
+    InvalidAlgorithmError,
+    InvalidIssuedAtError,
+    InvalidSignatureError,
+    MissingRequiredClaimError,
+    PyJWTError,
+    decode as jwt_decode,
+)
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_decode, base64url_encode
+
+from app.core.config import settings
+
+HS256: str = "HS256"
+
+# Algorithm, keys and header never change, build them once instead of per token
+algorithm = get_default_algorithms()[settings.ALGORITHM]
+# SECRET_KEY is read as bytes, tokens have always been signed with its str() form
+secret: str = str(settings.SECRET_KEY)
+secret_key: bytes = secret.encode()
+signing_key = algorithm.prepare_key(secret)
+hmac_algorithm: bool = settings.ALGORITHM.startswith("HS")
+header_segment: bytes = base64url_encode(
+    orjson.dumps({"typ": "JWT", "alg": settings.ALGORITHM})
+)
+
+
+def sign(signing_input: bytes) -> bytes:
+    if settings.ALGORITHM == HS256:
+        return hmac.new(secret_key, signing_input, hashlib.sha256).digest()
+    return algorithm.sign(signing_input, signing_key)
+
+
+def encode(payload: dict) -> str:
+    signing_input: bytes = (
+        header_segment + b"." + base64url_encode(orjson.dumps(payload))
+    )
+    return (signing_input + b"." + base64url_encode(sign(signing_input))).decode()
+
+
+async def encode_off_loop(payload: dict) -> str:
+    """
+    encode for coroutines, HMAC signatures are cheap and run inline while the
+    public key algorithms (RS*, ES*, PS*) are signed in the default executor
+    so the event loop keeps serving other requests
+    :param payload: claims of the token
+    :return: signed jwt token
+    """
+    if hmac_algorithm:
+        return encode(payload)
+    return await get_running_loop().run_in_executor(None, encode, payload)
+
+
+def decode(token: str) -> dict:
+    """
+    Verify and decode a token issued by encode
+    HS256 tokens are checked with hmac / hashlib directly, any other algorithm goes
+    through PyJWT. Both paths raise PyJWTError subclasses on invalid tokens, tokens
+    without "exp" included since every token issued here carries one
+    "exp", "nbf" and "iat" are checked like PyJWT does, without leeway
+    :param token: raw jwt token
+    :return: payload of the token
+    """
+    if settings.ALGORITHM != HS256:
+        return jwt_decode(
+            token,
+            secret,
+            algorithms=[settings.ALGORITHM],
+            options={"require": ["exp"]},
+        )
+
+    if token.count(".") != 2:
+        raise DecodeError("Wrong number of segments")
+    signing_input, _, signature_segment = token.encode().rpartition(b".")
+    token_header_segment, _, payload_segment = signing_input.partition(b".")
+    try:
+        header: dict = orjson.loads(base64url_decode(token_header_segment))
+        payload: dict = orjson.loads(base64url_decode(payload_segment))
+        signature: bytes = base64url_decode(signature_segment)
+    except (BinasciiError, ValueError):
+        raise DecodeError("Invalid token")
+    if not isinstance(header, dict) or not isinstance(payload, dict):
+        raise DecodeError("Invalid token")
+
+    if header.get("alg") != HS256:
+        raise InvalidAlgorithmError("The specified alg value is not allowed")
+    if not hmac.compare_digest(signature, sign(signing_input)):
+        raise InvalidSignatureError("Signature verification failed")
+
+    now: float = time.time()
+    exp: Optional[float] = numeric_claim(payload, "exp", DecodeError)
+    if exp is None:
+        raise MissingRequiredClaimError("exp")
+    if exp < now:
+        raise ExpiredSignatureError("Signature has expired")
+    nbf: Optional[float] = numeric_claim(payload, "nbf", DecodeError)
+    if nbf is not None and nbf > now:
+        raise ImmatureSignatureError("The token is not yet valid (nbf)")
+    numeric_claim(payload, "iat", InvalidIssuedAtError)
+
+    return payload
+
+
+def numeric_claim(
+    payload: dict, claim: str, error: Type[PyJWTError]
+) -> Optional[float]:
+    # Time claims may be any int or float as PyJWT allows, bool is not a number here
+    value: Any = payload.get(claim)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise error(f"The {claim} claim must be a number.")
+    return value
@@ -1,13 +1,21 @@
+import hashlib
+import logging
+import time
+from asyncio import Future, Lock, ensure_future, gather, wait
+from calendar import timegm
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Awaitable, Callable, FrozenSet, Optional, Set, Tuple
+from weakref import WeakValueDictionary
 
+from cachetools import TTLCache
 from fastapi import Depends, Header
-from jwt import PyJWTError, decode, encode
+from jwt import PyJWTError
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic.networks import EmailStr
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.status import HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND
 
+from app.core import jws
 from app.core.config import settings
 from app.core.database.mongodb import get_database
 from app.models.enums.token_subject import TokenSubject
@@ -16,6 +24,38 @@ from app.models.user import UserDB, UserTokenWrapper
 from app.repositories.token import save_token
 from app.repositories.user import get_user_by_email
 
+# Resolved tokens are kept for at most a minute and never past their own "exp"
+# The cache is per process, a user changed through one worker is evicted there only
+# and stays cached on the other workers for up to TOKEN_CACHE_TTL seconds
+TOKEN_CACHE_MAXSIZE = 10_000
+TOKEN_CACHE_TTL = 60
+
+token_cache: TTLCache = TTLCache(maxsize=TOKEN_CACHE_MAXSIZE, ttl=TOKEN_CACHE_TTL)
+# Email -> keys of the cached users, re-set on every insert so it outlives its keys
+token_cache_keys: TTLCache = TTLCache(maxsize=TOKEN_CACHE_MAXSIZE, ttl=TOKEN_CACHE_TTL)
+# A lock lives as long as a request holds or waits on it, never less
+token_cache_locks: WeakValueDictionary = WeakValueDictionary()
+
+# Headers carry "<JWT_TOKEN_PREFIX> <token>", the prefix is compared as a whole
+TOKEN_PREFIX: str = settings.JWT_TOKEN_PREFIX + " "
+TOKEN_PREFIX_LENGTH: int = len(TOKEN_PREFIX)
+
+# Token subjects travel as plain strings in the payload, hence the .value
+INVITATION_SUBJECTS: FrozenSet[str] = frozenset(
+    {
+        TokenSubject.GROUP_INVITE_CO_OWNER.value,
+        TokenSubject.GROUP_INVITE_MEMBER.value,
+        TokenSubject.USER_INVITE.value,
+    }
+)
+
+ACCESS_TOKEN_EXPIRES_DELTA: timedelta = timedelta(
+    minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES
+)
+
+# Access tokens are persisted off the response path, keep a reference until written
+token_writes: Set[Future] = set()
+
 
 class TokenUtils:
     @classmethod
@@ -25,11 +65,34 @@ class TokenUtils:
         subject: TokenSubject,
         group_id: str = None,
         user_email_invited: EmailStr = None,
-        token_expires_delta: timedelta = timedelta(
-            minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES
-        ),
+        token_expires_delta: timedelta = ACCESS_TOKEN_EXPIRES_DELTA,
     ) -> str:
-        token: str = await cls.create_token(
+        token_db: TokenDB = await cls.sign_user_db_data_into_token(
+            user_db,
+            subject=subject,
+            group_id=group_id,
+            user_email_invited=user_email_invited,
+            token_expires_delta=token_expires_delta,
+        )
+        await cls.store_token(token_db)
+
+        return token_db.token
+
+    @classmethod
+    async def sign_user_db_data_into_token(
+        cls,
+        user_db: UserDB,
+        subject: TokenSubject,
+        group_id: str = None,
+        user_email_invited: EmailStr = None,
+        token_expires_delta: timedelta = ACCESS_TOKEN_EXPIRES_DELTA,
+    ) -> TokenDB:
+        """
+        wrap_user_db_data_into_token without storing the token, for handlers that
+        sign while they still check whether the token will be handed out at all
+        :return: the signed token (.token), to pass to store_token once handed out
+        """
+        return await cls.sign_token(
             data={
                 "email": user_db.email,
                 "username": user_db.username,
@@ -40,59 +103,146 @@ class TokenUtils:
             subject=subject,
         )
 
-        return token
+    @classmethod
+    async def create_token(
+        cls, *, data: dict, expires_delta: timedelta = None, subject: TokenSubject
+    ) -> str:
+        token_db: TokenDB = await cls.sign_token(
+            data=data, expires_delta=expires_delta, subject=subject
+        )
+        await cls.store_token(token_db)
+        return token_db.token
 
     @staticmethod
-    async def create_token(
+    async def sign_token(
         *, data: dict, expires_delta: timedelta = None, subject: TokenSubject
-    ) -> str:
+    ) -> TokenDB:
         to_encode: dict = data.copy()
-        expire_datetime: datetime = datetime.utcnow() + timedelta(minutes=10)
-        if expires_delta:
-            expire_datetime: datetime = datetime.utcnow() + expires_delta
-        to_encode.update({"exp": expire_datetime, "subject": subject.value})
-
-        encoded_jwt = encode(
-            to_encode, str(settings.SECRET_KEY), algorithm=settings.ALGORITHM
+        now: datetime = datetime.utcnow()
+        expire_datetime: datetime = now + (expires_delta or timedelta(minutes=10))
+        to_encode.update(
+            {
+                "exp": timegm(expire_datetime.utctimetuple()),
+                "subject": subject.value,
+            }
         )
-        await save_token(
-            TokenDB(
-                **to_encode,
-                token=encoded_jwt,
-                created_at=datetime.utcnow(),
-                expire_datetime=expire_datetime
-            )
+
+        encoded_jwt: str = await jws.encode_off_loop(to_encode)
+        return TokenDB(
+            **to_encode,
+            token=encoded_jwt,
+            created_at=now,
+            expire_datetime=expire_datetime,
         )
-        return encoded_jwt
+
+    @staticmethod
+    async def store_token(token_db: TokenDB):
+        if token_db.subject == TokenSubject.ACCESS:
+            # Access tokens are never looked up in the database, losing one costs nothing
+            save_token_in_background(token_db, unacknowledged=True)
+        else:
+            # Any other token can be used as soon as the client gets it, store it first
+            await save_token(token_db)
+
+
+def save_token_in_background(token_db: TokenDB, unacknowledged: bool = False):
+    token_write: Future = ensure_future(save_token(token_db, unacknowledged))
+    token_writes.add(token_write)
+    token_write.add_done_callback(token_saved)
+
+
+def token_saved(token_write: Future):
+    token_writes.discard(token_write)
+    if not token_write.cancelled() and token_write.exception():
+        logging.error("Token save failed", exc_info=token_write.exception())
+
+
+async def wait_token_writes():
+    if token_writes:
+        await wait(set(token_writes))
+
+
+def token_cache_key(token: str, scope: str) -> bytes:
+    return hashlib.blake2b(
+        token.encode(), digest_size=16, person=scope.encode()
+    ).digest()
+
+
+def get_cached_token(key: bytes) -> Any:
+    cached: Optional[Tuple[Any, float]] = token_cache.get(key)
+    if cached is None:
+        return None
+    value, expire_timestamp = cached
+    if expire_timestamp <= time.time():
+        token_cache.pop(key, None)
+        return None
+    return value
 
 
-def get_token(
+async def resolve_token_cached(
+    token: str, scope: str, resolver: Callable[[], Awaitable[Tuple[Any, float]]]
+) -> Any:
+    """
+    Return the cached result of resolving a token, or resolve and cache it
+    The lock per key makes concurrent requests carrying the same token wait for
+    the first resolution instead of all hitting the database
+    :param token: raw jwt token
+    :param scope: kind of resolution (the same token may be resolved differently)
+    :param resolver: coroutine returning the value and the token "exp" timestamp
+    :return: value returned by the resolver, shared between requests (immutable)
+    """
+    key: bytes = token_cache_key(token, scope)
+    value: Any = get_cached_token(key)
+    if value is not None:
+        return value
+
+    lock: Optional[Lock] = token_cache_locks.get(key)
+    if lock is None:
+        lock = token_cache_locks[key] = Lock()
+    async with lock:
+        value = get_cached_token(key)
+        if value is not None:
+            return value
+        value, expire_timestamp = await resolver()
+        token_cache[key] = (value, expire_timestamp)
+        if isinstance(value, UserTokenWrapper):
+            keys: Set[bytes] = token_cache_keys.get(value.email) or set()
+            keys.add(key)
+            token_cache_keys[value.email] = keys
+        return value
+
+
+def evict_cached_user(email: str):
+    """
+    Drop the cached users resolved for an email, in this process only
+    Other workers keep serving their copy until it expires (TOKEN_CACHE_TTL)
+    :param email: email of the changed user
+    """
+    for key in token_cache_keys.pop(email, ()):
+        token_cache.pop(key, None)
+
+
+def strip_token_prefix(header: Optional[str], detail: str) -> str:
+    if (
+        not header
+        or len(header) <= TOKEN_PREFIX_LENGTH
+        or not header.startswith(TOKEN_PREFIX)
+    ):
+        raise StarletteHTTPException(status_code=HTTP_403_FORBIDDEN, detail=detail)
+    return header[TOKEN_PREFIX_LENGTH:]
+
+
+async def get_token(
     authorization: Optional[str] = Header(None),
     activation: Optional[str] = Header(None),
     recovery: Optional[str] = Header(None),
 ) -> str:
-    token: str
     if authorization:
-        prefix, token = authorization.split(" ")
-        if settings.JWT_TOKEN_PREFIX != prefix:
-            raise StarletteHTTPException(
-                status_code=HTTP_403_FORBIDDEN, detail="Invalid authorization"
-            )
-        return token
+        return strip_token_prefix(authorization, "Invalid authorization")
     if activation:
-        prefix, token = activation.split(" ")
-        if settings.JWT_TOKEN_PREFIX != prefix:
-            raise StarletteHTTPException(
-                status_code=HTTP_403_FORBIDDEN, detail="Invalid activation"
-            )
-        return token
+        return strip_token_prefix(activation, "Invalid activation")
     if recovery:
-        prefix, token = recovery.split(" ")
-        if settings.JWT_TOKEN_PREFIX != prefix:
-            raise StarletteHTTPException(
-                status_code=HTTP_403_FORBIDDEN, detail="Invalid recover"
-            )
-        return token
+        return strip_token_prefix(recovery, "Invalid recover")
 
     raise StarletteHTTPException(
         status_code=HTTP_403_FORBIDDEN, detail="Invalid header"
@@ -103,81 +253,98 @@ async def get_current_user(
     conn: AsyncIOMotorClient = Depends(get_database),
     token: str = Depends(get_token),
 ) -> UserTokenWrapper:
-    try:
-        payload: dict = decode(
-            token, str(settings.SECRET_KEY), algorithms=[settings.ALGORITHM]
-        )
-        token_data: TokenPayload = TokenPayload(**payload)
-    except PyJWTError:
-        raise StarletteHTTPException(
-            status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
-        )
+    async def resolve_current_user() -> Tuple[UserTokenWrapper, float]:
+        try:
+            payload: dict = jws.decode(token)
+            token_data: TokenPayload = TokenPayload.construct(**payload)
+        except PyJWTError:
+            raise StarletteHTTPException(
+                status_code=HTTP_403_FORBIDDEN, detail="Could not validate credentials"
+            )
 
-    user_db: UserDB = await get_user_by_email(conn, token_data.email)
-    if not user_db:
-        raise StarletteHTTPException(
-            status_code=HTTP_404_NOT_FOUND, detail="This user doesn't exist"
-        )
+        user_db: UserDB = await get_user_by_email(conn, token_data.email)
+        if not user_db:
+            raise StarletteHTTPException(
+                status_code=HTTP_404_NOT_FOUND, detail="This user doesn't exist"
+            )
 
-    return UserTokenWrapper(**user_db.dict(), token=token)
+        return UserTokenWrapper.from_user_db(user_db, token=token), payload["exp"]
 
+    return await resolve_token_cached(token, "current_user", resolve_current_user)
 
-async def get_invitation_token(invitation: str = Header(None)) -> str:
-    prefix, token = invitation.split(" ")
-    if settings.JWT_TOKEN_PREFIX != prefix:
-        raise StarletteHTTPException(
-            status_code=HTTP_403_FORBIDDEN, detail="Invalid invitation"
-        )
-    return token
+
+async def get_invitation_token(invitation: Optional[str] = Header(None)) -> str:
+    return strip_token_prefix(invitation, "Invalid invitation")
 
 
 async def get_user_from_invitation(
     conn: AsyncIOMotorClient = Depends(get_database),
     token: str = Depends(get_invitation_token),
 ) -> UserTokenWrapper:
-    try:
-        payload: dict = decode(
-            token, str(settings.SECRET_KEY), algorithms=[settings.ALGORITHM]
-        )
-        if not payload.get("subject") in (
-            TokenSubject.GROUP_INVITE_CO_OWNER,
-            TokenSubject.GROUP_INVITE_MEMBER,
-            TokenSubject.USER_INVITE,
-        ):
+    async def resolve_invited_user() -> Tuple[UserTokenWrapper, float]:
+        try:
+            payload: dict = jws.decode(token)
+            if payload.get("subject") not in INVITATION_SUBJECTS:
+                raise StarletteHTTPException(
+                    status_code=HTTP_403_FORBIDDEN,
+                    detail="This is not an invitation token",
+                )
+        except PyJWTError:
             raise StarletteHTTPException(
-                status_code=HTTP_403_FORBIDDEN, detail="This is not an invitation token"
+                status_code=HTTP_403_FORBIDDEN, detail="Could not validate invitation"
             )
-        token_data: TokenPayload = TokenPayload(**payload)
-    except PyJWTError:
-        raise StarletteHTTPException(
-            status_code=HTTP_403_FORBIDDEN, detail="Could not validate invitation"
-        )
-    user_db: UserDB = await get_user_by_email(conn, token_data.user_email_invited)
-    if not user_db:
-        raise StarletteHTTPException(
-            status_code=HTTP_404_NOT_FOUND, detail="This user doesn't exist"
+        user_db: UserDB = await get_user_by_email(
+            conn, payload.get("user_email_invited")
         )
+        if not user_db:
+            raise StarletteHTTPException(
+                status_code=HTTP_404_NOT_FOUND, detail="This user doesn't exist"
+            )
+
+        return UserTokenWrapper.from_user_db(user_db, token=token), payload["exp"]
 
-    return UserTokenWrapper(**user_db.dict(), token=token)
+    return await resolve_token_cached(token, "invited_user", resolve_invited_user)
+
+
+async def get_invited_and_current_user(
+    conn: AsyncIOMotorClient = Depends(get_database),
+    invitation_token: str = Depends(get_invitation_token),
+    token: str = Depends(get_token),
+) -> Tuple[UserTokenWrapper, UserTokenWrapper]:
+    """
+    Resolve the invitation and the access token together instead of one after the
+    other, when both miss the token cache their user lookups run at the same time
+    :param conn: MongoDB client
+    :param invitation_token: token from the invitation header
+    :param token: access token from the authorization header
+    :return: the invited user and the current user
+    """
+    user_invitation: UserTokenWrapper
+    user_current: UserTokenWrapper
+    user_invitation, user_current = await gather(
+        get_user_from_invitation(conn, invitation_token),
+        get_current_user(conn, token),
+    )
+    return user_invitation, user_current
 
 
 async def get_group_invitation(
     token: str = Depends(get_invitation_token),
 ) -> str:
-    try:
-        payload: dict = decode(
-            token, str(settings.SECRET_KEY), algorithms=[settings.ALGORITHM]
-        )
-        if not payload.get("subject") in (
-            TokenSubject.GROUP_INVITE_CO_OWNER,
-            TokenSubject.GROUP_INVITE_MEMBER,
-            TokenSubject.USER_INVITE,
-        ):
+    async def resolve_group_invitation() -> Tuple[str, float]:
+        try:
+            payload: dict = jws.decode(token)
+            if payload.get("subject") not in INVITATION_SUBJECTS:
+                raise StarletteHTTPException(
+                    status_code=HTTP_403_FORBIDDEN,
+                    detail="This is not an invitation token",
+                )
+            return token, payload["exp"]
+        except PyJWTError:
             raise StarletteHTTPException(
-                status_code=HTTP_403_FORBIDDEN, detail="This is not an invitation token"
+                status_code=HTTP_403_FORBIDDEN, detail="Could not validate invitation"
             )
-        return token
-    except PyJWTError:
-        raise StarletteHTTPException(
-            status_code=HTTP_403_FORBIDDEN, detail="Could not validate invitation"
-        )
+
+    return await resolve_token_cached(
+        token, "group_invitation", resolve_group_invitation
+    )
@@ -2,17 +2,23 @@ import logging
 
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.middleware.cors import CORSMiddleware
 
 from app.core.config import CustomFormatter, settings
-from app.core.database.mongodb_init import close_mongo_connection, connect_to_mongo
+from app.core.database.mongodb_init import (
+    close_mongo_connection,
+    connect_to_mongo,
+    create_mongo_indexes,
+)
 from app.core.errors import (
     http_exception_handler,
     internal_server_error_handler,
     not_found_error_handler,
     validation_exception_handler,
 )
+from app.core.jwt import wait_token_writes
 from app.core.scheduler.apscheduler_init import close_scheduler, connect_scheduler
 from app.core.smtp.smtp_init import close_smtp_connection, connect_to_smtp
 from app.routers.v1.router import (
@@ -31,7 +37,11 @@ rootLogger.addHandler(consoleHandler)
 rootLogger.setLevel(logging.INFO)
 
 # FastAPI app
-app = FastAPI(title=settings.APP_NAME, openapi_url="/api/v1/openapi.json")
+app = FastAPI(
+    title=settings.APP_NAME,
+    openapi_url="/api/v1/openapi.json",
+    default_response_class=ORJSONResponse,
+)
 
 # CORS - Set all CORS enabled origins
 origins = []
@@ -53,12 +63,14 @@ if settings.BACKEND_CORS_ORIGINS:
 
 async def app_startup():
     await connect_to_mongo()
+    await create_mongo_indexes()
     await connect_to_smtp()
     await connect_scheduler()
     await Scheduler.start_scheduler()
 
 
 async def app_shutdown():
+    await wait_token_writes()
     await close_mongo_connection()
     await close_smtp_connection()
     await Scheduler.stop_scheduler()
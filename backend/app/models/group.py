@@ -20,8 +20,7 @@ class GroupDB(DBModel, GroupBase):
     check_ins: List[Any] = []
 
     def add_co_owner(self, user: UserBase):
-        user_co_owner: Union[UserBase, bool] = self.user_is_co_owner(user)
-        if not user_co_owner:
+        if not self.user_is_co_owner(user):
             user_member: Union[UserBase, bool] = self.user_is_member(user)
             if user_member:
                 self.remove_member(user_member)
@@ -32,9 +31,7 @@ class GroupDB(DBModel, GroupBase):
             self.co_owners.remove(user)
 
     def add_member(self, user: UserBase):
-        user_member: Union[UserBase, bool] = self.user_is_member(user)
-        user_co_owner: Union[UserBase, bool] = self.user_is_co_owner(user)
-        if not user_member and not user_co_owner and not self.user_is_owner(user):
+        if not self.user_in_group(user):
             self.members.append(user)
 
     def remove_member(self, user: UserBase):
@@ -42,29 +39,36 @@ class GroupDB(DBModel, GroupBase):
             self.members.remove(user)
 
     def user_in_group(self, user: UserBase) -> bool:
-        if self.user_is_owner(user):
-            return True
-        if self.user_is_co_owner(user):
-            return True
-        if self.user_is_member(user):
-            return True
+        return self.role_of(user) is not None
 
-        return False
+    def role_of(self, user: UserBase) -> Optional[GroupRole]:
+        """
+        Resolve the role of a user with a single pass over owner, co_owners and members
+        Handlers should call it once and branch on the result instead of chaining
+        user_is_owner / user_is_co_owner / user_in_group, which scan the lists again
+        :param user: user entity that was created to query based on email
+        :return: GroupRole of the user or None if the user is not part of the group
+        """
+        if self.owner and self.owner.email == user.email:
+            return GroupRole.OWNER
+        for co_owner in self.co_owners:
+            if co_owner.email == user.email:
+                return GroupRole.CO_OWNER
+        for member in self.members:
+            if member.email == user.email:
+                return GroupRole.MEMBER
+
+        return None
 
     def remove_user(self, user: UserBase):
         self.remove_co_owner(user)
         self.remove_member(user)
 
     def user_is_owner(self, user: UserBase) -> bool:
-        if self.owner == user:
-            return True
-
-        return False
+        return self.role_of(user) == GroupRole.OWNER
 
-    def user_is_co_owner(self, user: UserBase) -> Union[UserBase, bool]:
-        if [co_owner for co_owner in self.co_owners if co_owner.email == user.email]:
-            return True
-        return False
+    def user_is_co_owner(self, user: UserBase) -> bool:
+        return self.role_of(user) == GroupRole.CO_OWNER
 
     def user_is_member(self, user: UserBase) -> Union[UserBase, bool]:
         member: Union[UserBase, bool] = self.member_object(user)
@@ -114,6 +118,19 @@ class GroupDB(DBModel, GroupBase):
 class GroupIdWrapper(GroupBase):
     id: Optional[str]
 
+    @classmethod
+    def from_group_db(cls, group_db: GroupDB, group_id: Any) -> "GroupIdWrapper":
+        return cls.construct(
+            **{field: getattr(group_db, field) for field in GroupBase.__fields__},
+            id=str(group_id),
+        )
+
+    def to_group_db(self) -> GroupDB:
+        values: dict = {field: getattr(self, field) for field in GroupBase.__fields__}
+        # The user lists are changed in place on the new GroupDB, copy only the lists
+        values.update(co_owners=list(self.co_owners), members=list(self.members))
+        return GroupDB.construct(**values)
+
 
 class GroupResponse(RWModel):
     group: GroupIdWrapper
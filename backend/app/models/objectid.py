@@ -0,0 +1,28 @@
+from typing import Any, Callable, Iterator
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+
+class PyObjectId(ObjectId):
+    """
+    ObjectId that FastAPI parses once while validating the request
+    Repositories receive it as is instead of converting the same string again
+    """
+
+    @classmethod
+    def __get_validators__(cls) -> Iterator[Callable[[Any], ObjectId]]:
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value: Any) -> ObjectId:
+        if isinstance(value, ObjectId):
+            return value
+        try:
+            return ObjectId(value)
+        except (InvalidId, TypeError):
+            raise ValueError("Invalid id")
+
+    @classmethod
+    def __modify_schema__(cls, field_schema: dict):
+        field_schema.update(type="string")
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Any, Optional
 
 from pydantic import EmailStr
 
@@ -15,6 +15,13 @@ class UserBase(RWModel):
     username: str
     is_active: bool = False
 
+    @classmethod
+    def from_user(cls, user: "UserBase", **values: Any) -> "UserBase":
+        # Fields are already validated, skip the dict() round trip
+        return cls.construct(
+            **{field: getattr(user, field) for field in UserBase.__fields__}, **values
+        )
+
 
 class UserDB(DBModel, UserBase):
     salt: str = ""
@@ -37,6 +44,18 @@ class UserDB(DBModel, UserBase):
 class UserTokenWrapper(UserBase):
     token: Optional[str]
 
+    class Config:
+        # Resolved users are cached and shared between concurrent requests
+        allow_mutation = False
+
+    @classmethod
+    def from_user_db(cls, user_db: UserBase, **values: Any) -> "UserTokenWrapper":
+        return cls.from_user(user_db, **values)
+
+    @property
+    def as_base(self) -> UserBase:
+        return UserBase.from_user(self)
+
 
 class UserResponse(RWModel):
     user: UserTokenWrapper
@@ -68,3 +87,11 @@ class UserUpdate(RWModel):
 class UserRecover(RWModel):
     email: EmailStr
     username: str
+
+
+class UserPassword(RWModel):
+    password: str
+
+
+class UserInvite(RWModel):
+    email_invited: EmailStr
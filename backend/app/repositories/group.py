@@ -1,8 +1,10 @@
 from datetime import datetime
-from typing import List, Tuple, Union
+from typing import AsyncIterator, Optional, Tuple, Union
 
 from bson.objectid import ObjectId
+from cachetools import TTLCache
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCursor
+from pydantic.networks import EmailStr
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.status import HTTP_404_NOT_FOUND
 
@@ -12,6 +14,18 @@ from app.models.user import UserBase
 
 COLLECTION_NAME = "groups"
 
+# Read-only handlers may see a group up to a few seconds old, writes evict it
+GROUP_CACHE_MAXSIZE = 1024
+GROUP_CACHE_TTL = 5
+
+group_cache: TTLCache = TTLCache(maxsize=GROUP_CACHE_MAXSIZE, ttl=GROUP_CACHE_TTL)
+
+
+def as_object_id(group_id: Union[ObjectId, str]) -> ObjectId:
+    if isinstance(group_id, ObjectId):
+        return group_id
+    return ObjectId(group_id)
+
 
 def check_group_object(
     group_object: dict, get_id: bool
@@ -28,43 +42,99 @@ def check_group_object(
 
 async def fetch_async_groups(
     groups_object: AsyncIOMotorCursor,
-) -> List[Tuple[GroupDB, ObjectId]]:
-    groups_db: List[Tuple[GroupDB, ObjectId]] = []
+) -> AsyncIterator[Tuple[GroupDB, ObjectId]]:
     async for group_object in groups_object:
-        group_db: Tuple[GroupDB, ObjectId] = check_group_object(
-            group_object, get_id=True
-        )
-        groups_db.append(group_db)
-
-    return groups_db
+        yield check_group_object(group_object, get_id=True)
 
 
 async def get_group_by_id(
     conn: AsyncIOMotorClient,
-    group_id: str,
+    group_id: Union[ObjectId, str],
     get_id: bool = False,
 ) -> Union[Tuple[GroupDB, ObjectId], GroupDB]:
     group_object: dict = await conn[settings.DATABASE_NAME][COLLECTION_NAME].find_one(
-        {"_id": ObjectId(group_id)}
+        {"_id": as_object_id(group_id)}
     )
     return check_group_object(group_object, get_id)
 
 
+async def get_group_by_id_cached(
+    conn: AsyncIOMotorClient, group_id: Union[ObjectId, str]
+) -> GroupDB:
+    """
+    Same as get_group_by_id, but the document is reused for GROUP_CACHE_TTL seconds
+    Only for handlers that read the group, anything that updates it must call
+    get_group_by_id so it works on the stored document
+    Writes in this process evict the group, every other worker keeps serving its copy
+    for up to GROUP_CACHE_TTL seconds, a kicked user or one who left still passes
+    the host role and "already in group" checks of invite / invite_qrcode there
+    :param conn: MongoDB client
+    :param group_id: id of the group
+    :return: a new GroupDB built from the cached document
+    """
+    group_object_id: ObjectId = as_object_id(group_id)
+    group_object: Optional[dict] = group_cache.get(group_cache_key(group_object_id))
+    if group_object is None:
+        group_object = await conn[settings.DATABASE_NAME][COLLECTION_NAME].find_one(
+            {"_id": group_object_id}
+        )
+        if group_object:
+            group_cache[group_cache_key(group_object_id)] = group_object
+    return check_group_object(group_object, get_id=False)
+
+
+def evict_cached_group(group_id: Union[ObjectId, str]):
+    group_cache.pop(group_cache_key(group_id), None)
+
+
+def group_cache_key(group_id: Union[ObjectId, str]) -> str:
+    # Any spelling of the id (e.g. uppercase hex) must land on the same entry
+    return str(as_object_id(group_id))
+
+
+async def get_group_by_id_for_user(
+    conn: AsyncIOMotorClient,
+    group_id: Union[ObjectId, str],
+    user_email: EmailStr,
+    get_id: bool = False,
+) -> Optional[Union[Tuple[GroupDB, ObjectId], GroupDB]]:
+    """
+    Fetch a group only if the user is part of it, the membership check runs in MongoDB
+    :param conn: MongoDB client
+    :param group_id: id of the group
+    :param user_email: email of the user that must be owner, co-owner or member
+    :param get_id: also return the ObjectId of the group
+    :return: the group or None if it doesn't exist or the user is not part of it
+    """
+    group_object: dict = await conn[settings.DATABASE_NAME][COLLECTION_NAME].find_one(
+        {
+            "_id": as_object_id(group_id),
+            "$or": [
+                {"owner.email": user_email},
+                {"co_owners.email": user_email},
+                {"members.email": user_email},
+            ],
+        }
+    )
+    if not group_object:
+        return None
+    return check_group_object(group_object, get_id)
+
+
 async def get_groups_by_user(
     conn: AsyncIOMotorClient, user_base: UserBase
-) -> List[Tuple[GroupDB, ObjectId]]:
+) -> AsyncIterator[Tuple[GroupDB, ObjectId]]:
     groups_object_as_owner: AsyncIOMotorCursor = conn[settings.DATABASE_NAME][
         COLLECTION_NAME
     ].find({"owner.email": user_base.email})
     # groups_object_as_co_owner: AsyncIOMotorCursor = None
     # groups_object_as_member: AsyncIOMotorCursor = None
 
-    groups_db_as_owner: List[Tuple[GroupDB, ObjectId]] = await fetch_async_groups(
-        groups_object_as_owner
-    )
-    # groups_db_as_co_owner: List[Tuple[GroupDB, ObjectId]]  = await fetch_async_groups(groups_object_as_co_owner)
-    # groups_db_as_member: List[Tuple[GroupDB, ObjectId]]  = await fetch_async_groups(groups_object_as_member)
-    return [*groups_db_as_owner]
+    # Groups are yielded as the cursor fetches them, no intermediate list is built
+    async for group_db in fetch_async_groups(groups_object_as_owner):
+        yield group_db
+    # async for group_db in fetch_async_groups(groups_object_as_co_owner): ...
+    # async for group_db in fetch_async_groups(groups_object_as_member): ...
 
 
 async def create_group(
@@ -85,7 +155,7 @@ async def update_group(
     group_current: GroupIdWrapper,
     group_update: GroupUpdate,
 ) -> Tuple[GroupDB, ObjectId]:
-    group_db: GroupDB = GroupDB(**group_current.dict())
+    group_db: GroupDB = group_current.to_group_db()
 
     group_db.updated_at = datetime.utcnow()
     group_db.name = group_update.name or group_db.name
@@ -101,6 +171,8 @@ async def update_group(
         {"_id": ObjectId(group_current.id)}, {"$set": group_db.dict()}
     )
 
+    evict_cached_group(group_current.id)
+
     return group_db, group_current.id
 
 
@@ -109,10 +181,12 @@ async def leave_group(
     group_current: GroupIdWrapper,
     user_base: UserBase,
 ) -> Tuple[GroupDB, ObjectId]:
-    group_db: GroupDB = GroupDB(**group_current.dict())
+    group_db: GroupDB = group_current.to_group_db()
     group_db.remove_user(user_base)
     await conn[settings.DATABASE_NAME][COLLECTION_NAME].update_one(
         {"_id": ObjectId(group_current.id)}, {"$set": group_db.dict()}
     )
 
+    evict_cached_group(group_current.id)
+
     return group_db, group_current.id
@@ -1,9 +1,14 @@
 from datetime import datetime
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from bson.objectid import ObjectId
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCursor
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorCollection,
+    AsyncIOMotorCursor,
+)
 from pydantic.networks import EmailStr
+from pymongo import IndexModel, ReturnDocument, WriteConcern
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.status import HTTP_404_NOT_FOUND
 
@@ -15,13 +20,44 @@ from app.models.token import TokenDB, TokenUpdate
 COLLECTION_NAME = "tokens"
 
 
+async def create_token_indexes(conn: AsyncIOMotorClient):
+    """
+    Index the token lookups and let MongoDB purge expired tokens on its own
+    Expired tokens are kept for EXPIRED_TOKENS_RETENTION_SECONDS because the
+    inactive users job looks for expired activation tokens before they go away
+    :param conn: MongoDB client
+    """
+    await conn[settings.DATABASE_NAME][COLLECTION_NAME].create_indexes(
+        [
+            IndexModel("token"),
+            IndexModel("email"),
+            IndexModel(
+                "expire_datetime",
+                expireAfterSeconds=settings.EXPIRED_TOKENS_RETENTION_SECONDS,
+            ),
+        ]
+    )
+
+
 def check_token_object(
-    token_object: dict, get_id: bool
+    token_object: dict, get_id: bool, partial: bool = False
 ) -> Union[Tuple[TokenDB, ObjectId], TokenDB]:
     if token_object:
+        token_db: TokenDB
+        if partial:
+            # Projected documents lack required fields, only the projected ones are set
+            token_db = TokenDB.construct(
+                **{
+                    field: value
+                    for field, value in token_object.items()
+                    if field in TokenDB.__fields__
+                }
+            )
+        else:
+            token_db = TokenDB(**token_object)
         if get_id:
-            return TokenDB(**token_object), token_object.get("_id")
-        return TokenDB(**token_object)
+            return token_db, token_object.get("_id")
+        return token_db
 
     raise StarletteHTTPException(
         status_code=HTTP_404_NOT_FOUND, detail="This token doesn't exist"
@@ -48,12 +84,57 @@ async def fetch_async_tokens(
 
 
 async def get_token(
-    conn: AsyncIOMotorClient, token: str, get_id: bool = False
+    conn: AsyncIOMotorClient,
+    token: str,
+    get_id: bool = False,
+    projection: Optional[dict] = None,
 ) -> TokenDB:
+    """
+    Fetch an issued token
+    :param conn: MongoDB client
+    :param token: raw jwt token
+    :param get_id: also return the ObjectId of the token
+    :param projection: fields to fetch, the returned TokenDB only has these set
+    :return: the token, with its ObjectId if get_id
+    """
     token_object: dict = await conn[settings.DATABASE_NAME][COLLECTION_NAME].find_one(
-        {"token": token}
+        {"token": token}, projection=projection
+    )
+    return check_token_object(token_object, get_id, partial=projection is not None)
+
+
+async def consume_token(
+    conn: AsyncIOMotorClient,
+    token: str,
+    *,
+    subject: Optional[TokenSubject] = None,
+    user_email_invited: Optional[EmailStr] = None,
+) -> Optional[TokenDB]:
+    """
+    Mark a token as used in the same operation that checks it, so a token can't be
+    used twice even by concurrent requests
+    :param conn: MongoDB client
+    :param token: raw jwt token
+    :param subject: the token must have this subject
+    :param user_email_invited: the token must be an invitation for this email
+    :return: the token as it was before being used or None if no unused token matched
+    """
+    token_filter: dict = {"token": token, "used_at": None}
+    if subject:
+        token_filter["subject"] = subject
+    if user_email_invited:
+        token_filter["user_email_invited"] = user_email_invited
+
+    token_object: Optional[dict] = await conn[settings.DATABASE_NAME][
+        COLLECTION_NAME
+    ].find_one_and_update(
+        token_filter,
+        {"$currentDate": {"used_at": True, "updated_at": True}},
+        return_document=ReturnDocument.BEFORE,
     )
-    return check_token_object(token_object, get_id)
+    if not token_object:
+        return None
+    return TokenDB(**token_object)
 
 
 async def get_tokens_by_subject_and_lt_datetime(
@@ -95,24 +176,60 @@ async def get_tokens_by_email(
     return await fetch_async_tokens(tokens_object, get_ids)
 
 
-async def save_token(token: TokenDB) -> TokenDB:
-    conn: AsyncIOMotorClient = await get_database()
-    await conn[settings.DATABASE_NAME][COLLECTION_NAME].insert_one(token.dict())
-    return token
+async def mark_tokens_deleted_by_email(
+    conn: AsyncIOMotorClient, email: EmailStr
+) -> int:
+    result: any = await conn[settings.DATABASE_NAME][COLLECTION_NAME].update_many(
+        {"email": email, "deleted": False},
+        {"$set": {"deleted": True}, "$currentDate": {"updated_at": True}},
+    )
+    return result.modified_count
 
 
-async def update_token(conn: AsyncIOMotorClient, token_update: TokenUpdate) -> TokenDB:
-    token_db: TokenDB
-    token_db_id: str
-    token_db, token_db_id = await get_token(conn, token_update.token, get_id=True)
+async def save_token(token: TokenDB, unacknowledged: bool = False) -> TokenDB:
+    """
+    Insert an issued token
+    :param token: token to insert
+    :param unacknowledged: write with w=0, only for tokens that are never read back
+    :return: the inserted token
+    """
+    conn: AsyncIOMotorClient = await get_database()
+    collection: AsyncIOMotorCollection = conn[settings.DATABASE_NAME][COLLECTION_NAME]
+    if unacknowledged:
+        collection = collection.with_options(write_concern=WriteConcern(w=0))
+    await collection.insert_one(token.dict())
+    return token
 
-    token_db.updated_at = datetime.utcnow()
-    token_db.used_at = token_update.used_at or token_db.used_at
-    if token_db.deleted is not True and token_update.deleted is True:
-        token_db.deleted = token_update.deleted
 
-    await conn[settings.DATABASE_NAME][COLLECTION_NAME].update_one(
-        {"_id": ObjectId(token_db_id)}, {"$set": token_db.dict()}
+async def update_token(
+    conn: AsyncIOMotorClient, token_update: TokenUpdate, mark_used: bool = False
+) -> TokenDB:
+    """
+    Apply token_update with a single find_one_and_update
+    :param conn: MongoDB client
+    :param token_update: token to update and the fields to change
+    :param mark_used: let MongoDB stamp used_at with its own clock
+    :return: the token after the update
+    """
+    token_fields: dict = {}
+    if token_update.used_at:
+        token_fields["used_at"] = token_update.used_at
+    if token_update.deleted is True:
+        token_fields["deleted"] = True
+
+    token_current_date: dict = {"updated_at": True}
+    if mark_used:
+        token_current_date["used_at"] = True
+
+    token_changes: dict = {"$currentDate": token_current_date}
+    if token_fields:
+        token_changes["$set"] = token_fields
+
+    token_object: Optional[dict] = await conn[settings.DATABASE_NAME][
+        COLLECTION_NAME
+    ].find_one_and_update(
+        {"token": token_update.token},
+        token_changes,
+        return_document=ReturnDocument.AFTER,
     )
-
-    return token_db
+    return check_token_object(token_object, get_id=False)
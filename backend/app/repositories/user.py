@@ -1,10 +1,12 @@
 import logging
-from datetime import datetime
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from bson.objectid import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import EmailStr
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.status import (
     HTTP_400_BAD_REQUEST,
@@ -13,20 +15,68 @@ from starlette.status import (
     HTTP_500_INTERNAL_SERVER_ERROR,
 )
 
+from app.core import security
 from app.core.config import settings
 from app.models.user import UserCreate, UserDB, UserTokenWrapper, UserUpdate
 
 COLLECTION_NAME = "users"
 
+# Fields copied from UserUpdate when they are set, the rest need extra handling
+USER_UPDATE_FIELDS = ("email", "first_name", "second_name", "last_name", "username")
+
+
+async def create_user_indexes(conn: AsyncIOMotorClient):
+    """
+    Index the user lookups, MongoDB also guarantees that emails and usernames
+    are unique so updates don't need to check availability beforehand
+    :param conn: MongoDB client
+    """
+    await conn[settings.DATABASE_NAME][COLLECTION_NAME].create_indexes(
+        [IndexModel("email", unique=True), IndexModel("username", unique=True)]
+    )
+
+
+def raise_user_already_exists(exc: DuplicateKeyError):
+    # MongoDB reports the violated unique index as keyPattern (keyValue as well)
+    details: dict = exc.details or {}
+    duplicate_key: dict = details.get("keyPattern") or details.get("keyValue") or {}
+    if "username" in duplicate_key:
+        raise StarletteHTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="User with this username already exists",
+        )
+    raise StarletteHTTPException(
+        status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="User with this email already exists",
+    )
+
 
 def check_user_object(
-    user_object: dict, get_id: bool, raise_bad_request: bool
-) -> Union[Tuple[UserDB, ObjectId], UserDB]:
+    user_object: dict,
+    get_id: bool,
+    raise_bad_request: bool,
+    allow_missing: bool = False,
+    partial: bool = False,
+) -> Optional[Union[Tuple[UserDB, ObjectId], UserDB]]:
     if user_object:
+        user_db: UserDB
+        if partial:
+            # Projected documents lack required fields, only the projected ones are set
+            user_db = UserDB.construct(
+                **{
+                    field: value
+                    for field, value in user_object.items()
+                    if field in UserDB.__fields__
+                }
+            )
+        else:
+            user_db = UserDB(**user_object)
         if get_id:
-            return UserDB(**user_object), user_object.get("_id")
-        return UserDB(**user_object)
+            return user_db, user_object.get("_id")
+        return user_db
 
+    if allow_missing:
+        return None
     if raise_bad_request:
         raise StarletteHTTPException(
             status_code=HTTP_400_BAD_REQUEST, detail="Invalid credentials"
@@ -41,11 +91,30 @@ async def get_user_by_email(
     email: EmailStr,
     get_id: bool = False,
     raise_bad_request: bool = False,
-) -> Union[Tuple[UserDB, ObjectId], UserDB]:
+    *,
+    allow_missing: bool = False,
+    projection: Optional[dict] = None,
+) -> Optional[Union[Tuple[UserDB, ObjectId], UserDB]]:
+    """
+    Fetch a user by email
+    :param conn: MongoDB client
+    :param email: email of the user
+    :param get_id: also return the ObjectId of the user
+    :param raise_bad_request: answer 400 Invalid credentials instead of 404
+    :param allow_missing: return None instead of raising when the user doesn't exist
+    :param projection: fields to fetch, the returned UserDB only has these set
+    :return: the user, with its ObjectId if get_id
+    """
     user_object: dict = await conn[settings.DATABASE_NAME][COLLECTION_NAME].find_one(
-        {"email": email}
+        {"email": email}, projection=projection
+    )
+    return check_user_object(
+        user_object,
+        get_id,
+        raise_bad_request,
+        allow_missing,
+        partial=projection is not None,
     )
-    return check_user_object(user_object, get_id, raise_bad_request)
 
 
 async def get_user_by_username(
@@ -53,11 +122,20 @@ async def get_user_by_username(
     username: str,
     get_id: bool = False,
     raise_bad_request: bool = False,
-) -> Union[Tuple[UserDB, ObjectId], UserDB]:
+    *,
+    allow_missing: bool = False,
+    projection: Optional[dict] = None,
+) -> Optional[Union[Tuple[UserDB, ObjectId], UserDB]]:
     user_object: dict = await conn[settings.DATABASE_NAME][COLLECTION_NAME].find_one(
-        {"username": username}
+        {"username": username}, projection=projection
+    )
+    return check_user_object(
+        user_object,
+        get_id,
+        raise_bad_request,
+        allow_missing,
+        partial=projection is not None,
     )
-    return check_user_object(user_object, get_id, raise_bad_request)
 
 
 async def get_user_by_id(
@@ -74,45 +152,83 @@ async def get_user_by_id(
 
 async def create_user(conn: AsyncIOMotorClient, user_create: UserCreate) -> UserDB:
     user_db: UserDB = UserDB(**user_create.dict())
-    user_db.change_password(user_create.password)
-    await conn[settings.DATABASE_NAME][COLLECTION_NAME].insert_one(user_db.dict())
+    await run_in_threadpool(user_db.change_password, user_create.password)
+    try:
+        await conn[settings.DATABASE_NAME][COLLECTION_NAME].insert_one(user_db.dict())
+    except DuplicateKeyError as exc:
+        raise_user_already_exists(exc)
     return user_db
 
 
+async def password_fields(password: str) -> dict:
+    salt: str = security.generate_salt()
+    # bcrypt is slow on purpose, hash in the threadpool to keep the event loop free
+    hashed_password: str = await run_in_threadpool(
+        security.get_password_hash, salt + password
+    )
+    return {"salt": salt, "hashed_password": hashed_password}
+
+
+async def update_user_fields(
+    conn: AsyncIOMotorClient, user_current: UserTokenWrapper, user_fields: dict
+) -> UserDB:
+    """
+    $set the given fields of a user with a single find_one_and_update
+    updated_at is stamped by MongoDB itself with $currentDate
+    An email or username that is already taken is rejected by the unique indexes
+    :param conn: MongoDB client
+    :param user_current: user that is updated
+    :param user_fields: document fields and their new values
+    :return: the user after the update
+    """
+    user_changes: dict = {"$currentDate": {"updated_at": True}}
+    if user_fields:
+        user_changes["$set"] = user_fields
+
+    try:
+        user_object: dict = await conn[settings.DATABASE_NAME][
+            COLLECTION_NAME
+        ].find_one_and_update(
+            {"email": user_current.email},
+            user_changes,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError as exc:
+        raise_user_already_exists(exc)
+
+    return check_user_object(user_object, get_id=False, raise_bad_request=False)
+
+
 async def update_user(
     conn: AsyncIOMotorClient, user_current: UserTokenWrapper, user_update: UserUpdate
 ) -> UserDB:
-    user_db: UserDB
-    user_db_id: ObjectId
-    user_db, user_db_id = await get_user_by_email(conn, user_current.email, get_id=True)
-
-    user_db.updated_at = datetime.utcnow()
-    user_db.email = user_update.email or user_db.email
-    user_db.first_name = user_update.first_name or user_db.first_name
-    user_db.second_name = user_update.second_name or user_db.second_name
-    user_db.last_name = user_update.last_name or user_db.last_name
-    user_db.username = user_update.username or user_db.username
-
-    if (
-        user_db.is_active is False
-        and user_update.is_active is not None
-        and user_update.is_active is True
-    ):
-        user_db.activate()
+    """
+    Apply the fields set in user_update, unset fields are left as they are
+    :param conn: MongoDB client
+    :param user_current: user that is updated
+    :param user_update: fields to change
+    :return: the user after the update
+    """
+    user_fields: dict = {}
+    for field in USER_UPDATE_FIELDS:
+        value: Optional[str] = getattr(user_update, field)
+        if value:
+            user_fields[field] = value
 
-    if user_update.password:
-        user_db.change_password(user_update.password)
+    if user_update.is_active is True:
+        user_fields["is_active"] = True
 
-    await conn[settings.DATABASE_NAME][COLLECTION_NAME].update_one(
-        {"_id": user_db_id}, {"$set": user_db.dict()}
-    )
+    if user_update.password:
+        user_fields.update(await password_fields(user_update.password))
 
-    return user_db
+    return await update_user_fields(conn, user_current, user_fields)
 
 
 async def delete_user(conn: AsyncIOMotorClient, user_current: UserTokenWrapper) -> bool:
     user_db_id: ObjectId
-    _, user_db_id = await get_user_by_email(conn, user_current.email, get_id=True)
+    _, user_db_id = await get_user_by_email(
+        conn, user_current.email, get_id=True, projection={"_id": True}
+    )
 
     result: any = await conn[settings.DATABASE_NAME][COLLECTION_NAME].delete_one(
         {"_id": user_db_id},
@@ -132,26 +248,32 @@ async def check_availability_username_and_email(
     email: Optional[EmailStr] = None,
     username: Optional[str] = None,
 ):
+    user_filters: List[dict] = []
     if email:
-        try:
-            await get_user_by_email(conn, email)
-        except StarletteHTTPException:
-            ...
-        else:
-            raise StarletteHTTPException(
-                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="User with this email already exists",
-            )
+        user_filters.append({"email": email})
     if username:
-        try:
-            await get_user_by_username(conn, username)
-        except StarletteHTTPException:
-            ...
-        else:
-            raise StarletteHTTPException(
-                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="User with this username already exists",
-            )
+        user_filters.append({"username": username})
+    if not user_filters:
+        return
+
+    # One query for both, if each clashes with a different user either is reported
+    user_object: Optional[dict] = await conn[settings.DATABASE_NAME][
+        COLLECTION_NAME
+    ].find_one(
+        {"$or": user_filters},
+        projection={"_id": False, "email": True, "username": True},
+    )
+    if not user_object:
+        return
+    if email and user_object.get("email") == email:
+        raise StarletteHTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="User with this email already exists",
+        )
+    raise StarletteHTTPException(
+        status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="User with this username already exists",
+    )
 
 
 async def check_user_active(
@@ -3,6 +3,7 @@ from datetime import timedelta
 from fastapi import APIRouter, BackgroundTasks, Body, Depends
 from fastapi_mail import FastMail
 from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST
 
@@ -27,6 +28,13 @@ from app.services.email import background_send_new_account_email
 
 router = APIRouter()
 
+ACTIVATE_TOKEN_EXPIRES_DELTA: timedelta = timedelta(
+    minutes=settings.ACTIVATE_TOKEN_EXPIRE_MINUTES
+)
+ACTIVATION_LINK_PREFIX: str = (
+    f"{settings.FRONTEND_DNS}{settings.FRONTEND_ACTIVATION_PATH}?token="
+)
+
 
 @router.post(
     "/register",
@@ -48,20 +56,19 @@ async def register(
         token: str = await TokenUtils.wrap_user_db_data_into_token(
             user_db, subject=TokenSubject.ACCESS
         )
-        token_activation_expires_delta = timedelta(
-            minutes=settings.ACTIVATE_TOKEN_EXPIRE_MINUTES
-        )  # 7 days
         token_activation: str = await TokenUtils.wrap_user_db_data_into_token(
             user_db,
             subject=TokenSubject.ACTIVATE,
-            token_expires_delta=token_activation_expires_delta,
+            token_expires_delta=ACTIVATE_TOKEN_EXPIRES_DELTA,
         )
 
-        action_link: str = f"{settings.FRONTEND_DNS}{settings.FRONTEND_ACTIVATION_PATH}?token={token_activation}"
-        await background_send_new_account_email(
+        action_link: str = ACTIVATION_LINK_PREFIX + token_activation
+        background_send_new_account_email(
             smtp_conn, background_tasks, user_db.email, action_link
         )
-        return UserResponse(user=UserTokenWrapper(**user_db.dict(), token=token))
+        return UserResponse.construct(
+            user=UserTokenWrapper.from_user_db(user_db, token=token)
+        )
 
 
 @router.post(
@@ -77,11 +84,13 @@ async def login(
     user_db: UserDB = await get_user_by_email(
         conn, user_login.email, raise_bad_request=True
     )
-    if not user_db.check_password(user_login.password):
+    if not await run_in_threadpool(user_db.check_password, user_login.password):
         raise StarletteHTTPException(
             status_code=HTTP_400_BAD_REQUEST, detail="Invalid credentials"
         )
     token: str = await TokenUtils.wrap_user_db_data_into_token(
         user_db, subject=TokenSubject.ACCESS
     )
-    return UserResponse(user=UserTokenWrapper(**user_db.dict(), token=token))
+    return UserResponse.construct(
+        user=UserTokenWrapper.from_user_db(user_db, token=token)
+    )
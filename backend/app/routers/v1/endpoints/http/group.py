@@ -1,18 +1,19 @@
-from typing import List, Tuple
+from asyncio import gather
+from typing import Dict, Optional, Tuple
 
 from bson.objectid import ObjectId
 from fastapi import APIRouter, BackgroundTasks, Body, Depends
 from fastapi_mail import FastMail
 from motor.motor_asyncio import AsyncIOMotorClient
 from starlette.exceptions import HTTPException as StarletteHTTPException
-from starlette.status import HTTP_200_OK, HTTP_403_FORBIDDEN
+from starlette.status import HTTP_200_OK, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND
 
 from app.core.config import settings
 from app.core.database.mongodb import get_database
 from app.core.jwt import (
     get_current_user,
     get_group_invitation,
-    get_user_from_invitation,
+    get_invited_and_current_user,
 )
 from app.core.smtp.smtp import get_smtp
 from app.models.enums.group_role import GroupRole
@@ -28,10 +29,13 @@ from app.models.group import (
     GroupResponse,
     GroupsResponse,
 )
+from app.models.objectid import PyObjectId
 from app.models.user import UserBase, UserDB, UserTokenWrapper
 from app.repositories.group import (
     create_group,
     get_group_by_id,
+    get_group_by_id_cached,
+    get_group_by_id_for_user,
     get_groups_by_user,
     leave_group,
 )
@@ -40,6 +44,18 @@ from app.utils.group import process_invitation, process_invitation_qrcode, proce
 
 router = APIRouter()
 
+# Token subject and expiry minutes of each role that can be invited
+INVITE_DISPATCH: Dict[GroupRole, Tuple[TokenSubject, int]] = {
+    GroupRole.CO_OWNER: (
+        TokenSubject.GROUP_INVITE_CO_OWNER,
+        settings.GROUP_INVITE_CO_OWNER_TOKEN_EXPIRE_MINUTES,
+    ),
+    GroupRole.MEMBER: (
+        TokenSubject.GROUP_INVITE_MEMBER,
+        settings.GROUP_INVITE_MEMBER_TOKEN_EXPIRE_MINUTES,
+    ),
+}
+
 
 @router.get(
     "/",
@@ -51,16 +67,15 @@ async def groups(
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> GroupsResponse:
-    groups_db: List[Tuple[GroupDB, ObjectId]] = await get_groups_by_user(
-        conn, UserBase(**user_current.dict())
+    return GroupsResponse.construct(
+        groups=[
+            GroupIdWrapper.from_group_db(group_db, group_db_id)
+            async for group_db, group_db_id in get_groups_by_user(
+                conn, user_current.as_base
+            )
+        ]
     )
 
-    groups_id_wrapper: List[GroupIdWrapper] = []
-    for group_db, group_db_id in groups_db:
-        groups_id_wrapper.append(GroupIdWrapper(**group_db.dict(), id=str(group_db_id)))
-
-    return GroupsResponse(groups=groups_id_wrapper)
-
 
 @router.get(
     "/{group_id}",
@@ -69,13 +84,15 @@ async def groups(
     response_model_exclude_unset=True,
 )
 async def group_by_id(
-    group_id: str,
+    group_id: PyObjectId,
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> GroupResponse:
-    group_db: GroupDB = await get_group_by_id(conn, group_id)
-    if group_db.user_in_group(UserBase(**user_current.dict())):
-        return GroupResponse(group=GroupIdWrapper(**group_db.dict(), id=group_id))
+    group_db: Optional[GroupDB] = await get_group_by_id_for_user(
+        conn, group_id, user_current.email
+    )
+    if group_db:
+        return GroupResponse(group=GroupIdWrapper.from_group_db(group_db, group_id))
 
     raise StarletteHTTPException(
         status_code=HTTP_403_FORBIDDEN, detail="User is not in the group"
@@ -97,11 +114,9 @@ async def create(
         group_db: GroupDB
         group_db_id: ObjectId
         group_db, group_db_id = await create_group(
-            conn, group_create, UserBase(**user_current.dict())
-        )
-        return GroupResponse(
-            group=GroupIdWrapper(**group_db.dict(), id=str(group_db_id))
+            conn, group_create, user_current.as_base
         )
+        return GroupResponse(group=GroupIdWrapper.from_group_db(group_db, group_db_id))
 
 
 @router.post(
@@ -117,25 +132,26 @@ async def invite(
     conn: AsyncIOMotorClient = Depends(get_database),
     smtp_conn: FastMail = Depends(get_smtp),
 ) -> GenericResponse:
-    group_db: GroupDB = await get_group_by_id(conn, group_invite.group_id)
-    user_host: UserBase = UserBase(**user_current.dict())
+    group_db: GroupDB
+    user_invited: Optional[UserDB]
+    group_db, user_invited = await gather(
+        get_group_by_id_cached(conn, group_invite.group_id),
+        get_user_by_email(conn, group_invite.email, allow_missing=True),
+    )
+    user_host: UserBase = user_current.as_base
+    user_host_role: Optional[GroupRole] = group_db.role_of(user_host)
 
-    if group_db.user_is_owner(user_host) or group_db.user_is_co_owner(user_host):
+    if user_host_role in (GroupRole.OWNER, GroupRole.CO_OWNER):
         if group_invite.role == GroupRole.OWNER:
             raise StarletteHTTPException(
                 status_code=HTTP_403_FORBIDDEN, detail="Owner role is unique"
             )
 
-        # This is a mock that will be replace if there is a user with the desired email
+        # Unknown emails get a mock user instead of the registered one
         # TODO: FRONTEND will take care to register/login a user before joining a group
-        user_invited: UserDB = UserDB(
+        user_invited = user_invited or UserDB.construct(
             email=group_invite.email, first_name="", last_name="", username=""
         )
-        try:
-            user_invited: UserDB = await get_user_by_email(conn, group_invite.email)
-        except StarletteHTTPException as exc:
-            if not (exc.status_code == 404 and exc.detail == "This user doesn't exist"):
-                raise exc
 
         # There will be no problem with mocked user_invited, because you can't be part
         # of any group if you are not registered.
@@ -144,34 +160,28 @@ async def invite(
                 status_code=HTTP_403_FORBIDDEN, detail="User already in group"
             )
 
-        if group_invite.role == GroupRole.CO_OWNER:
-            if group_db.user_is_co_owner(user_host):
-                raise StarletteHTTPException(
-                    status_code=HTTP_403_FORBIDDEN,
-                    detail="User is not allowed to invite another co-owner",
-                )
-            await process_invitation(
-                background_tasks,
-                smtp_conn,
-                group_db,
-                group_invite,
-                user_host,
-                user_invited,
-                TokenSubject.GROUP_INVITE_CO_OWNER,
-                settings.GROUP_INVITE_CO_OWNER_TOKEN_EXPIRE_MINUTES,
+        if (
+            group_invite.role == GroupRole.CO_OWNER
+            and user_host_role == GroupRole.CO_OWNER
+        ):
+            raise StarletteHTTPException(
+                status_code=HTTP_403_FORBIDDEN,
+                detail="User is not allowed to invite another co-owner",
             )
 
-        if group_invite.role == GroupRole.MEMBER:
-            await process_invitation(
-                background_tasks,
-                smtp_conn,
-                group_db,
-                group_invite,
-                user_host,
-                user_invited,
-                TokenSubject.GROUP_INVITE_MEMBER,
-                settings.GROUP_INVITE_MEMBER_TOKEN_EXPIRE_MINUTES,
-            )
+        subject: TokenSubject
+        expire_minutes: int
+        subject, expire_minutes = INVITE_DISPATCH[group_invite.role]
+        await process_invitation(
+            background_tasks,
+            smtp_conn,
+            group_db,
+            group_invite,
+            user_host,
+            user_invited,
+            subject,
+            expire_minutes,
+        )
 
         return GenericResponse(
             status=GenericStatus.RUNNING,
@@ -190,10 +200,14 @@ async def invite(
     response_model_exclude_unset=True,
 )
 async def join(
-    user_invitation: UserTokenWrapper = Depends(get_user_from_invitation),
-    user_current: UserTokenWrapper = Depends(get_current_user),
+    users: Tuple[UserTokenWrapper, UserTokenWrapper] = Depends(
+        get_invited_and_current_user
+    ),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> GroupResponse:
+    user_invitation: UserTokenWrapper
+    user_current: UserTokenWrapper
+    user_invitation, user_current = users
     if user_current.email == user_invitation.email:
         return await process_join(conn, user_invitation.token, user_current)
 
@@ -213,39 +227,33 @@ async def invite_qrcode(
     group_invite: GroupInvite = Body(..., embed=True),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> GroupInviteQRCodeResponse:
-    group_db: GroupDB = await get_group_by_id(conn, group_invite.group_id)
-    user_host: UserBase = UserBase(**user_current.dict())
+    group_db: GroupDB = await get_group_by_id_cached(conn, group_invite.group_id)
+    user_host: UserBase = user_current.as_base
+    user_host_role: Optional[GroupRole] = group_db.role_of(user_host)
 
-    if group_db.user_is_owner(user_host) or group_db.user_is_co_owner(user_host):
+    if user_host_role in (GroupRole.OWNER, GroupRole.CO_OWNER):
         if group_invite.role == GroupRole.OWNER:
             raise StarletteHTTPException(
                 status_code=HTTP_403_FORBIDDEN, detail="Owner role is unique"
             )
 
-        if group_invite.role == GroupRole.CO_OWNER:
-            if group_db.user_is_co_owner(user_host):
-                raise StarletteHTTPException(
-                    status_code=HTTP_403_FORBIDDEN,
-                    detail="User is not allowed to invite another co-owner",
-                )
-            return GroupInviteQRCodeResponse(
-                invite_link=await process_invitation_qrcode(
-                    group_invite,
-                    user_host,
-                    TokenSubject.GROUP_INVITE_CO_OWNER,
-                    settings.GROUP_INVITE_CO_OWNER_TOKEN_EXPIRE_MINUTES,
-                )
+        if (
+            group_invite.role == GroupRole.CO_OWNER
+            and user_host_role == GroupRole.CO_OWNER
+        ):
+            raise StarletteHTTPException(
+                status_code=HTTP_403_FORBIDDEN,
+                detail="User is not allowed to invite another co-owner",
             )
 
-        if group_invite.role == GroupRole.MEMBER:
-            return GroupInviteQRCodeResponse(
-                invite_link=await process_invitation_qrcode(
-                    group_invite,
-                    user_host,
-                    TokenSubject.GROUP_INVITE_MEMBER,
-                    settings.GROUP_INVITE_MEMBER_TOKEN_EXPIRE_MINUTES,
-                )
+        subject: TokenSubject
+        expire_minutes: int
+        subject, expire_minutes = INVITE_DISPATCH[group_invite.role]
+        return GroupInviteQRCodeResponse(
+            invite_link=await process_invitation_qrcode(
+                group_invite, user_host, subject, expire_minutes
             )
+        )
 
     raise StarletteHTTPException(
         status_code=HTTP_403_FORBIDDEN, detail="User is not allowed to invite"
@@ -273,15 +281,17 @@ async def join_qrcode(
     response_model_exclude_unset=True,
 )
 async def leave(
-    group_id: str,
+    group_id: PyObjectId,
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> GenericResponse:
-    group_db: GroupDB = await get_group_by_id(conn, group_id)
-    user_base: UserBase = UserBase(**user_current.dict())
-    if group_db.user_in_group(user_base):
-        group_id_wrapper: GroupIdWrapper = GroupIdWrapper(
-            **group_db.dict(), id=str(group_id)
+    group_db: Optional[GroupDB] = await get_group_by_id_for_user(
+        conn, group_id, user_current.email
+    )
+    if group_db:
+        user_base: UserBase = user_current.as_base
+        group_id_wrapper: GroupIdWrapper = GroupIdWrapper.from_group_db(
+            group_db, group_id
         )
         await leave_group(conn, group_id_wrapper, user_base)
         return GenericResponse(
@@ -305,27 +315,37 @@ async def kick(
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> GenericResponse:
-    group_db: GroupDB = await get_group_by_id(conn, group_kick.id)
-    user_base: UserBase = UserBase(**user_current.dict())
-    if group_db.user_in_group(user_base):
-        user_base_is_owner: bool = group_db.user_is_owner(user_base)
-        user_base_is_co_owner: bool = group_db.user_is_co_owner(user_base)
-        if user_base_is_owner or user_base_is_co_owner:
-            user_kick_db: UserDB = await get_user_by_email(conn, group_kick.email)
-            user_kick: UserBase = UserBase(**user_kick_db.dict())
-            if group_db.user_in_group(user_kick):
-                if group_db.user_is_owner(user_kick):
+    group_db: GroupDB
+    user_kick_db: Optional[UserDB]
+    group_db, user_kick_db = await gather(
+        get_group_by_id(conn, group_kick.id),
+        get_user_by_email(conn, group_kick.email, allow_missing=True),
+    )
+    user_base_role: Optional[GroupRole] = group_db.role_of(user_current)
+    if user_base_role:
+        if user_base_role in (GroupRole.OWNER, GroupRole.CO_OWNER):
+            if not user_kick_db:
+                raise StarletteHTTPException(
+                    status_code=HTTP_404_NOT_FOUND, detail="This user doesn't exist"
+                )
+            user_kick: UserBase = UserBase.from_user(user_kick_db)
+            user_kick_role: Optional[GroupRole] = group_db.role_of(user_kick)
+            if user_kick_role:
+                if user_kick_role == GroupRole.OWNER:
                     raise StarletteHTTPException(
                         status_code=HTTP_403_FORBIDDEN,
                         detail="Owner of the group can't be kicked",
                     )
-                if group_db.user_is_co_owner(user_kick) and user_base_is_co_owner:
+                if (
+                    user_kick_role == GroupRole.CO_OWNER
+                    and user_base_role == GroupRole.CO_OWNER
+                ):
                     raise StarletteHTTPException(
                         status_code=HTTP_403_FORBIDDEN,
                         detail="Co-owner is not allowed to kick other co-owner",
                     )
-                group_id_wrapper: GroupIdWrapper = GroupIdWrapper(
-                    **group_db.dict(), id=str(group_kick.id)
+                group_id_wrapper: GroupIdWrapper = GroupIdWrapper.from_group_db(
+                    group_db, group_kick.id
                 )
                 await leave_group(conn, group_id_wrapper, user_kick)
                 return GenericResponse(
@@ -1,53 +1,80 @@
-from datetime import datetime, timedelta
-from typing import AnyStr, Optional
+from asyncio import gather
+from datetime import timedelta
+from functools import lru_cache
+from typing import Optional, Tuple
 
 from fastapi import APIRouter, BackgroundTasks, Body, Depends, Header
+from fastapi.responses import ORJSONResponse
 from fastapi_mail import FastMail
 from httpagentparser import simple_detect
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic.networks import EmailStr
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.status import HTTP_200_OK, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND
 
 from app.core.config import settings
 from app.core.database.mongodb import get_database
-from app.core.jwt import TokenUtils, get_current_user, get_user_from_invitation
+from app.core.jwt import (
+    TokenUtils,
+    evict_cached_user,
+    get_current_user,
+    get_invited_and_current_user,
+)
 from app.core.smtp.smtp import get_smtp
 from app.models.enums.token_subject import TokenSubject
 from app.models.generic_response import GenericResponse, GenericStatus
-from app.models.token import TokenDB, TokenUpdate
+from app.models.token import TokenDB
 from app.models.user import (
     UserDB,
+    UserInvite,
+    UserPassword,
     UserRecover,
     UserResponse,
     UserTokenWrapper,
     UserUpdate,
 )
-from app.repositories.token import get_token, update_token
+from app.repositories.token import consume_token, get_token
 from app.repositories.user import (
-    check_availability_username_and_email,
     delete_user,
     get_user_by_email,
+    password_fields,
     update_user,
+    update_user_fields,
 )
 from app.services.email import (
     background_send_recovery_email,
     background_send_user_invite_email,
 )
+from app.utils.group import GROUP_INVITE_LINK_PREFIX
 
 router = APIRouter()
 
+RECOVER_TOKEN_EXPIRES_DELTA: timedelta = timedelta(
+    minutes=settings.RECOVER_TOKEN_EXPIRE_MINUTES
+)
+USER_INVITE_TOKEN_EXPIRES_DELTA: timedelta = timedelta(
+    minutes=settings.USER_INVITE_TOKEN_EXPIRE_MINUTES
+)
+RECOVERY_LINK_PREFIX: str = (
+    f"{settings.FRONTEND_DNS}{settings.FRONTEND_RECOVERY_PATH}?token="
+)
+
+
+@lru_cache(maxsize=4096)
+def detect_user_agent(user_agent: Optional[str]) -> Tuple[str, str]:
+    # Clients send the same few user agents over and over, parse each one once
+    return simple_detect(user_agent)
+
 
 @router.get(
     "/",
-    response_model=UserResponse,
+    response_class=ORJSONResponse,
+    responses={HTTP_200_OK: {"model": UserResponse}},
     status_code=HTTP_200_OK,
-    response_model_exclude_unset=True,
 )
 async def current(
     user_current: UserTokenWrapper = Depends(get_current_user),
-) -> UserResponse:
-    return UserResponse(user=user_current)
+) -> ORJSONResponse:
+    return ORJSONResponse({"user": user_current.dict(exclude_unset=True)})
 
 
 @router.put(
@@ -67,11 +94,9 @@ async def update_current(
     user_update.email = (
         None if user_update.email == user_current.email else user_update.email
     )
-    await check_availability_username_and_email(
-        conn, user_update.email, user_update.username
-    )
     user_db: UserDB = await update_user(conn, user_current, user_update)
-    return UserResponse(user=UserTokenWrapper(**user_db.dict()))
+    evict_cached_user(user_current.email)
+    return UserResponse.construct(user=UserTokenWrapper.from_user_db(user_db))
 
 
 @router.patch(
@@ -84,16 +109,19 @@ async def activate(
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> UserResponse:
+    token_db: Optional[TokenDB] = await consume_token(
+        conn, user_current.token, subject=TokenSubject.ACTIVATE
+    )
+    if token_db:
+        user_db: UserDB = await update_user_fields(
+            conn, user_current, {"is_active": True}
+        )
+        evict_cached_user(user_current.email)
+        return UserResponse.construct(user=UserTokenWrapper.from_user_db(user_db))
+
+    # Nothing was consumed, look the token up only to tell the client why
     token_db: TokenDB = await get_token(conn, user_current.token)
     if token_db.subject == TokenSubject.ACTIVATE:
-        if not token_db.used_at:
-            user_db: UserDB = await update_user(
-                conn, user_current, UserUpdate(is_active=True)
-            )
-            await update_token(
-                conn, TokenUpdate(token=token_db.token, used_at=datetime.utcnow())
-            )
-            return UserResponse(user=UserTokenWrapper(**user_db.dict()))
         raise StarletteHTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Token has expired"
         )
@@ -104,9 +132,9 @@ async def activate(
 
 @router.post(
     "/recover",
-    response_model=GenericResponse,
+    response_class=ORJSONResponse,
+    responses={HTTP_200_OK: {"model": GenericResponse}},
     status_code=HTTP_200_OK,
-    response_model_exclude_unset=True,
 )
 async def recover(
     background_tasks: BackgroundTasks,
@@ -114,25 +142,28 @@ async def recover(
     user_recover: UserRecover = Body(..., embed=True),
     conn: AsyncIOMotorClient = Depends(get_database),
     smtp_conn: FastMail = Depends(get_smtp),
-) -> GenericResponse:
-    user_db: UserDB = await get_user_by_email(conn, user_recover.email)
+) -> ORJSONResponse:
+    user_db: UserDB = await get_user_by_email(
+        conn, user_recover.email, projection={"email": True, "username": True}
+    )
     if user_db.username == user_recover.username:
         os: str
         browser: str
-        os, browser = simple_detect(user_agent)
-        token_recovery_expires_delta = timedelta(minutes=60 * 24 * 1)  # 24 hours
+        os, browser = detect_user_agent(user_agent)
         token_recovery: str = await TokenUtils.wrap_user_db_data_into_token(
             user_db,
             subject=TokenSubject.RECOVER,
-            token_expires_delta=token_recovery_expires_delta,
+            token_expires_delta=RECOVER_TOKEN_EXPIRES_DELTA,
         )
-        action_link: str = f"{settings.FRONTEND_DNS}{settings.FRONTEND_RECOVERY_PATH}?token={token_recovery}"
-        await background_send_recovery_email(
+        action_link: str = RECOVERY_LINK_PREFIX + token_recovery
+        background_send_recovery_email(
             smtp_conn, background_tasks, user_db.email, action_link, os, browser
         )
-        return GenericResponse(
-            status=GenericStatus.RUNNING,
-            message="Recovery account email has been processed",
+        return ORJSONResponse(
+            {
+                "status": GenericStatus.RUNNING.value,
+                "message": "Recovery account email has been processed",
+            }
         )
     raise StarletteHTTPException(
         status_code=HTTP_404_NOT_FOUND, detail="This user doesn't exist"
@@ -147,19 +178,23 @@ async def recover(
 )
 async def change_password(
     user_current: UserTokenWrapper = Depends(get_current_user),
-    password: AnyStr = Body(..., embed=True),
+    user_password: UserPassword = Body(...),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> UserResponse:
+    token_db: Optional[TokenDB] = await consume_token(
+        conn, user_current.token, subject=TokenSubject.RECOVER
+    )
+    if token_db:
+        user_fields: dict = {}
+        if user_password.password:
+            user_fields = await password_fields(user_password.password)
+        user_db: UserDB = await update_user_fields(conn, user_current, user_fields)
+        evict_cached_user(user_current.email)
+        return UserResponse.construct(user=UserTokenWrapper.from_user_db(user_db))
+
+    # Nothing was consumed, look the token up only to tell the client why
     token_db: TokenDB = await get_token(conn, user_current.token)
     if token_db.subject == TokenSubject.RECOVER:
-        if not token_db.used_at:
-            user_db: UserDB = await update_user(
-                conn, user_current, UserUpdate(password=password)
-            )
-            await update_token(
-                conn, TokenUpdate(token=token_db.token, used_at=datetime.utcnow())
-            )
-            return UserResponse(user=UserTokenWrapper(**user_db.dict()))
         raise StarletteHTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Token has expired"
         )
@@ -170,62 +205,70 @@ async def change_password(
 
 @router.delete(
     "/",
-    response_model=GenericResponse,
+    response_class=ORJSONResponse,
+    responses={HTTP_200_OK: {"model": GenericResponse}},
     status_code=HTTP_200_OK,
-    response_model_exclude_unset=True,
 )
 async def delete_current(
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
-) -> GenericResponse:
+) -> ORJSONResponse:
     if await delete_user(conn, user_current):
-        return GenericResponse(
-            status=GenericStatus.COMPLETED, message="Account deleted"
+        evict_cached_user(user_current.email)
+        return ORJSONResponse(
+            {"status": GenericStatus.COMPLETED.value, "message": "Account deleted"}
         )
 
 
 @router.post(
     "/invite",
-    response_model=GenericResponse,
+    response_class=ORJSONResponse,
+    responses={HTTP_200_OK: {"model": GenericResponse}},
     status_code=HTTP_200_OK,
-    response_model_exclude_unset=True,
 )
 async def invite_user(
     background_tasks: BackgroundTasks,
-    email_invited: EmailStr = Body(..., embed=True),
+    user_invite: UserInvite = Body(...),
     user_current: UserTokenWrapper = Depends(get_current_user),
     conn: AsyncIOMotorClient = Depends(get_database),
     smtp_conn: FastMail = Depends(get_smtp),
-) -> GenericResponse:
-    try:
-        await get_user_by_email(conn, email_invited)
+) -> ORJSONResponse:
+    # The token is signed while MongoDB answers, it is stored only if handed out
+    user_invited: Optional[UserDB]
+    token_db: TokenDB
+    user_invited, token_db = await gather(
+        get_user_by_email(
+            conn,
+            user_invite.email_invited,
+            allow_missing=True,
+            projection={"_id": True},
+        ),
+        TokenUtils.sign_user_db_data_into_token(
+            user_current,
+            user_email_invited=user_invite.email_invited,
+            subject=TokenSubject.USER_INVITE,
+            token_expires_delta=USER_INVITE_TOKEN_EXPIRES_DELTA,
+        ),
+    )
+    if user_invited:
         raise StarletteHTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="This user already exist"
         )
-    except StarletteHTTPException as exc:
-        if exc.status_code == 403 and exc.detail == "This user already exist":
-            raise exc
 
-        token_user_invite_expires_delta = timedelta(
-            minutes=settings.USER_INVITE_TOKEN_EXPIRE_MINUTES
-        )
-        token_user_invite: str = await TokenUtils.wrap_user_db_data_into_token(
-            user_current,
-            user_email_invited=email_invited,
-            subject=TokenSubject.USER_INVITE,
-            token_expires_delta=token_user_invite_expires_delta,
-        )
-        action_link: str = f"{settings.FRONTEND_DNS}{settings.FRONTEND_GROUP_INVITE}?token={token_user_invite}"
-        await background_send_user_invite_email(
-            smtp_conn,
-            background_tasks,
-            email_invited,
-            action_link,
-        )
-        return GenericResponse(
-            status=GenericStatus.RUNNING,
-            message="Group invite email has been processed",
-        )
+    await TokenUtils.store_token(token_db)
+    action_link: str = GROUP_INVITE_LINK_PREFIX + token_db.token
+    background_send_user_invite_email(
+        smtp_conn,
+        background_tasks,
+        user_invite.email_invited,
+        action_link,
+    )
+    return ORJSONResponse(
+        {
+            "status": GenericStatus.RUNNING.value,
+            "message": "Group invite email has been processed",
+        }
+    )
 
 
 @router.post(
@@ -235,19 +278,25 @@ async def invite_user(
     response_model_exclude_unset=True,
 )
 async def join_via_invitation(
-    user_invitation: UserTokenWrapper = Depends(get_user_from_invitation),
-    user_current: UserTokenWrapper = Depends(get_current_user),
+    users: Tuple[UserTokenWrapper, UserTokenWrapper] = Depends(
+        get_invited_and_current_user
+    ),
     conn: AsyncIOMotorClient = Depends(get_database),
 ) -> UserResponse:
+    user_invitation: UserTokenWrapper
+    user_current: UserTokenWrapper
+    user_invitation, user_current = users
     # TODO: Create a user_friends entity in database and link them.
     # TODO: Create gamification to encourage users to become part of the community
+    token_db: Optional[TokenDB] = await consume_token(
+        conn, user_invitation.token, user_email_invited=user_current.email
+    )
+    if token_db:
+        return UserResponse.construct(user=user_current)
+
+    # Nothing was consumed, look the token up only to tell the client why
     token_db: TokenDB = await get_token(conn, user_invitation.token)
     if not token_db.used_at:
-        if user_current.email == token_db.user_email_invited:
-            await update_token(
-                conn, TokenUpdate(token=token_db.token, used_at=datetime.utcnow())
-            )
-            return UserResponse(user=UserTokenWrapper(**user_current.dict()))
         raise StarletteHTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="This user was not invited"
         )
@@ -1,18 +1,42 @@
-from typing import AnyStr, Union
+from typing import Any, AnyStr, Callable, Union
 
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString, Tag
 from fastapi import BackgroundTasks
 from fastapi_mail import FastMail, MessageSchema
 from pydantic.networks import EmailStr
+from starlette.concurrency import run_in_threadpool
 
 
-async def background_send_new_account_email(
+async def send_rendered_message(
+    smtp_conn: FastMail, render: Callable[..., MessageSchema], *args: Any
+):
+    """
+    Render and send an email after the response went out
+    Templates are read and parsed in the threadpool, only sending uses the event loop
+    :param smtp_conn: FastMail connection
+    :param render: function that builds the MessageSchema
+    :param args: arguments of render
+    """
+    message_schema: MessageSchema = await run_in_threadpool(render, *args)
+    await smtp_conn.send_message(message_schema)
+
+
+def background_send_new_account_email(
     smtp_conn: FastMail,
     background_tasks: BackgroundTasks,
     email: EmailStr,
     action_link: str,
 ):
+    background_tasks.add_task(
+        send_rendered_message, smtp_conn, render_new_account_email, email, action_link
+    )
+
+
+def render_new_account_email(
+    email: EmailStr,
+    action_link: str,
+) -> MessageSchema:
     with open("email-templates/new_account.html") as html_file:
         text: AnyStr = html_file.read()
         soup: BeautifulSoup = BeautifulSoup(text, "lxml")
@@ -32,10 +56,10 @@ async def background_send_new_account_email(
         body=str(soup),
         subtype="html",
     )
-    background_tasks.add_task(smtp_conn.send_message, message_schema)
+    return message_schema
 
 
-async def background_send_recovery_email(
+def background_send_recovery_email(
     smtp_conn: FastMail,
     background_tasks: BackgroundTasks,
     email: EmailStr,
@@ -43,6 +67,23 @@ async def background_send_recovery_email(
     os: str,
     browser: str,
 ):
+    background_tasks.add_task(
+        send_rendered_message,
+        smtp_conn,
+        render_recovery_email,
+        email,
+        action_link,
+        os,
+        browser,
+    )
+
+
+def render_recovery_email(
+    email: EmailStr,
+    action_link: str,
+    os: str,
+    browser: str,
+) -> MessageSchema:
     with open("email-templates/recovery_account.html") as html_file:
         text: AnyStr = html_file.read()
         soup: BeautifulSoup = BeautifulSoup(text, "lxml")
@@ -69,15 +110,24 @@ async def background_send_recovery_email(
         body=str(soup),
         subtype="html",
     )
-    background_tasks.add_task(smtp_conn.send_message, message_schema)
+    return message_schema
 
 
-async def background_send_user_invite_email(
+def background_send_user_invite_email(
     smtp_conn: FastMail,
     background_tasks: BackgroundTasks,
     email: EmailStr,
     action_link: str,
 ):
+    background_tasks.add_task(
+        send_rendered_message, smtp_conn, render_user_invite_email, email, action_link
+    )
+
+
+def render_user_invite_email(
+    email: EmailStr,
+    action_link: str,
+) -> MessageSchema:
     with open("email-templates/user_invite.html") as html_file:
         text: AnyStr = html_file.read()
         soup: BeautifulSoup = BeautifulSoup(text, "lxml")
@@ -97,16 +147,31 @@ async def background_send_user_invite_email(
         body=str(soup),
         subtype="html",
     )
-    background_tasks.add_task(smtp_conn.send_message, message_schema)
+    return message_schema
 
 
-async def background_send_group_invite_email(
+def background_send_group_invite_email(
     smtp_conn: FastMail,
     background_tasks: BackgroundTasks,
     email: EmailStr,
     action_link: str,
     group_name: str,
 ):
+    background_tasks.add_task(
+        send_rendered_message,
+        smtp_conn,
+        render_group_invite_email,
+        email,
+        action_link,
+        group_name,
+    )
+
+
+def render_group_invite_email(
+    email: EmailStr,
+    action_link: str,
+    group_name: str,
+) -> MessageSchema:
     with open("email-templates/group_invite.html") as html_file:
         text: AnyStr = html_file.read()
         soup: BeautifulSoup = BeautifulSoup(text, "lxml")
@@ -131,4 +196,4 @@ async def background_send_group_invite_email(
         body=str(soup),
         subtype="html",
     )
-    background_tasks.add_task(smtp_conn.send_message, message_schema)
+    return message_schema
@@ -3,14 +3,14 @@ from typing import List
 
 from app.core.config import settings
 from app.core.database.mongodb import get_database
+from app.core.jwt import evict_cached_user
 from app.core.scheduler.apscheduler import get_scheduler
 from app.models.enums.token_subject import TokenSubject
-from app.models.token import TokenDB, TokenUpdate
+from app.models.token import TokenDB
 from app.models.user import UserDB, UserTokenWrapper
 from app.repositories.token import (
-    get_tokens_by_email,
     get_tokens_by_subject_and_lt_datetime,
-    update_token,
+    mark_tokens_deleted_by_email,
 )
 from app.repositories.user import delete_user, get_user_by_email
 
@@ -42,11 +42,6 @@ class Scheduler:
         )
         for token_db in tokens_db:
             user_db: UserDB = await get_user_by_email(conn, token_db.email)
-            await delete_user(conn, UserTokenWrapper(**user_db.dict()))
-            tokens_db_current_email: List[TokenDB] = await get_tokens_by_email(
-                conn, token_db.email
-            )
-            for token_db_current_email in tokens_db_current_email:
-                await update_token(
-                    conn, TokenUpdate(token=token_db_current_email.token, deleted=True)
-                )
+            await delete_user(conn, UserTokenWrapper.from_user_db(user_db))
+            evict_cached_user(user_db.email)
+            await mark_tokens_deleted_by_email(conn, token_db.email)
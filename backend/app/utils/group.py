@@ -1,4 +1,5 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
+from typing import Optional
 
 from bson.objectid import ObjectId
 from fastapi import BackgroundTasks
@@ -17,11 +18,15 @@ from app.models.group import (
     GroupResponse,
     GroupUpdate,
 )
-from app.models.token import TokenDB, TokenUpdate
-from app.models.user import UserBase, UserDB, UserTokenWrapper
+from app.models.token import TokenDB
+from app.models.user import UserDB, UserTokenWrapper
+from app.repositories.group import get_group_by_id, update_group
+from app.repositories.token import consume_token, get_token
 from app.services.email import background_send_group_invite_email
-from repositories.group import get_group_by_id, update_group
-from repositories.token import get_token, update_token
+
+GROUP_INVITE_LINK_PREFIX: str = (
+    f"{settings.FRONTEND_DNS}{settings.FRONTEND_GROUP_INVITE}?token="
+)
 
 
 async def process_invitation(
@@ -42,10 +47,8 @@ async def process_invitation(
         subject=token_subject_role,
         token_expires_delta=token_invite_expires_delta,
     )
-    action_link: str = (
-        f"{settings.FRONTEND_DNS}{settings.FRONTEND_GROUP_INVITE}?token={token_invite}"
-    )
-    await background_send_group_invite_email(
+    action_link: str = GROUP_INVITE_LINK_PREFIX + token_invite
+    background_send_group_invite_email(
         smtp_conn,
         background_tasks,
         user_invited.email,
@@ -67,32 +70,30 @@ async def process_invitation_qrcode(
         subject=token_subject_role,
         token_expires_delta=token_invite_expires_delta,
     )
-    return (
-        f"{settings.FRONTEND_DNS}{settings.FRONTEND_GROUP_INVITE}?token={token_invite}"
-    )
+    return GROUP_INVITE_LINK_PREFIX + token_invite
 
 
 async def process_join(
     conn: AsyncIOMotorClient, invitation_token: str, user_current: UserTokenWrapper
 ):
-    token_db: TokenDB = await get_token(conn, invitation_token)
-    if token_db.used_at:
+    # Using the token up front lets a single one of concurrent joins through
+    token_db: Optional[TokenDB] = await consume_token(conn, invitation_token)
+    if not token_db:
+        # Nothing was consumed, a missing token still gets its 404 from get_token
+        await get_token(conn, invitation_token, projection={"_id": True})
         raise StarletteHTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Invitation token already used"
         )
 
-    group_db: GroupDB
-    group_db_id: str
-    group_db, group_db_id = await get_group_by_id(conn, token_db.group_id, get_id=True)
+    group_db_id: ObjectId = ObjectId(token_db.group_id)
+    group_db: GroupDB = await get_group_by_id(conn, group_db_id)
 
-    group_update: GroupUpdate = GroupUpdate(member=UserBase(**user_current.dict()))
+    group_update: GroupUpdate = GroupUpdate(member=user_current.as_base)
     if token_db.subject == TokenSubject.GROUP_INVITE_CO_OWNER:
-        group_update: GroupUpdate = GroupUpdate(
-            co_owner=UserBase(**user_current.dict())
-        )
+        group_update: GroupUpdate = GroupUpdate(co_owner=user_current.as_base)
 
-    group_id_wrapper: GroupIdWrapper = GroupIdWrapper(
-        **group_db.dict(), id=str(group_db_id)
+    group_id_wrapper: GroupIdWrapper = GroupIdWrapper.from_group_db(
+        group_db, group_db_id
     )
     group_db_updated: GroupDB
     group_db_id_updated: ObjectId
@@ -100,10 +101,6 @@ async def process_join(
         conn, group_id_wrapper, group_update
     )
 
-    await update_token(
-        conn, TokenUpdate(token=token_db.token, used_at=datetime.utcnow())
-    )
-
     return GroupResponse(
-        group=GroupIdWrapper(**group_db_updated.dict(), id=str(group_db_id_updated))
+        group=GroupIdWrapper.from_group_db(group_db_updated, group_db_id_updated)
     )